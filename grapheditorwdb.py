@@ -42,6 +42,14 @@ class GraphEditor(QGraphicsView):
         self.car_mode = False # For car-specific edge weights
         self.car_mode_button_updater = None # To link with sidebar button state for car mode
 
+        # Lưới chỉ mục không gian cho cạnh: (cx, cy) -> set các cạnh có bounding box chạm ô đó
+        self.edge_index_cell_size = 100
+        self.edge_index = {}
+        self.edge_cells = {} # edge -> list các ô, để gỡ cạnh khỏi lưới không cần tọa độ node
+        self.edge_index_bounds = None # (cx_min, cx_max, cy_min, cy_max); chỉ nới ra, thu lại khi build lại
+        # place_id -> {'from', 'to', 'x', 'y', 'offset', 'dist'}: cạnh gần nhất của mỗi special place
+        self.place_attachments = {}
+
         self.load_graph()
 
     def set_special_place_mode(self, enabled):
@@ -102,6 +110,19 @@ class GraphEditor(QGraphicsView):
                 y REAL
             )
         """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS special_place_edges (
+                place_id TEXT PRIMARY KEY,
+                node_from TEXT,
+                node_to TEXT,
+                proj_x REAL,
+                proj_y REAL,
+                edge_offset REAL,
+                distance REAL,
+                FOREIGN KEY (place_id) REFERENCES special_places(id),
+                FOREIGN KEY (node_from, node_to) REFERENCES edges(node_from, node_to)
+            )
+        """)
         self.conn.commit()
     def remove_edge(self, edge):
         # edge is a tuple (node_from, node_to)
@@ -141,6 +162,7 @@ class GraphEditor(QGraphicsView):
         
         if edge_to_remove_from_list in self.edges:
             self.edges.remove(edge_to_remove_from_list)
+            self.on_edges_removed([edge_to_remove_from_list])
         
         # Delete from DB (try both directions if your DB might store undirected edges one way)
         self.cursor.execute("DELETE FROM edges WHERE (node_from = ? AND node_to = ?) OR (node_from = ? AND node_to = ?)", 
@@ -166,6 +188,7 @@ class GraphEditor(QGraphicsView):
                     self.special_places[place_id] = {'name': custom_name, 'x': scene_pos.x(), 'y': scene_pos.y()}
                     self.cursor.execute("INSERT INTO special_places (id, custom_name, x, y) VALUES (?, ?, ?, ?)",
                                         (place_id, custom_name, scene_pos.x(), scene_pos.y()))
+                    self.attach_special_places([place_id])
                     self.conn.commit()
                     self.draw_special_place(scene_pos, custom_name, place_id) # Use scene_pos
                     self.undo_stack.append(("special_place_added", place_id, custom_name, scene_pos.x(), scene_pos.y()))
@@ -225,6 +248,7 @@ class GraphEditor(QGraphicsView):
 
         del self.special_places[place_id]
         self.cursor.execute("DELETE FROM special_places WHERE id = ?", (place_id,))
+        self.detach_special_place(place_id)
         self.conn.commit()
 
         print(f"Special place removed: {place_data.get('name', place_id)}")
@@ -256,13 +280,14 @@ class GraphEditor(QGraphicsView):
         # Xóa node khỏi database
         self.cursor.execute("DELETE FROM nodes WHERE name = ?", (node_name,))
         self.cursor.execute("DELETE FROM edges WHERE node_from = ? OR node_to = ?", (node_name, node_name))
-        self.conn.commit()
 
         # Xóa node và các cạnh liên quan khỏi bộ nhớ
         del self.nodes[node_name]
         for edge in edges_to_remove_for_undo:
             if edge in self.edges:
                 self.edges.remove(edge)
+        self.on_edges_removed(edges_to_remove_for_undo)
+        self.conn.commit()
 
         print(f"Node {node_name} removed.")
         self.redraw_graph()
@@ -317,9 +342,12 @@ class GraphEditor(QGraphicsView):
         self.edges.append((node1, node2)) # Storing as (from, to)
         
         self.cursor.execute("INSERT INTO edges (node_from, node_to, weight) VALUES (?, ?, ?)", (node1, node2, weight))
+        moved_places = self.on_edges_added([(node1, node2)])
         self.conn.commit()
         self.undo_stack.append(("edge_added", node1, node2, weight)) 
         print(f"Edge added: {node1} -> {node2} with {edge_description} weight: {weight:.2f}")
+        if moved_places: # Nét nối của các place vừa chuyển sang cạnh mới cần vẽ lại
+            self.redraw_graph()
     def calculate_weight(self,node1, node2):
         x1, y1 = self.nodes[node1]
         x2, y2 = self.nodes[node2]
@@ -354,6 +382,156 @@ class GraphEditor(QGraphicsView):
                 print(f"Clicked on edge: {node1} -> {node2}")
                 return (node1, node2)
         return None
+
+    def edge_index_cells(self, node1, node2):
+        # Các ô lưới mà bounding box của cạnh đi qua
+        x1, y1 = self.nodes[node1]
+        x2, y2 = self.nodes[node2]
+        size = self.edge_index_cell_size
+        cx_min, cx_max = int(min(x1, x2) // size), int(max(x1, x2) // size)
+        cy_min, cy_max = int(min(y1, y2) // size), int(max(y1, y2) // size)
+        return [(cx, cy) for cx in range(cx_min, cx_max + 1) for cy in range(cy_min, cy_max + 1)]
+
+    def index_edge(self, edge):
+        if edge in self.edge_cells or edge[0] not in self.nodes or edge[1] not in self.nodes:
+            return
+        cells = self.edge_index_cells(edge[0], edge[1])
+        self.edge_cells[edge] = cells
+        (cx_lo, cy_lo), (cx_hi, cy_hi) = cells[0], cells[-1]
+        if self.edge_index_bounds is None:
+            self.edge_index_bounds = (cx_lo, cx_hi, cy_lo, cy_hi)
+        else:
+            bx_min, bx_max, by_min, by_max = self.edge_index_bounds
+            self.edge_index_bounds = (min(bx_min, cx_lo), max(bx_max, cx_hi), min(by_min, cy_lo), max(by_max, cy_hi))
+        for cell in cells:
+            self.edge_index.setdefault(cell, set()).add(edge)
+
+    def unindex_edge(self, edge):
+        for cell in self.edge_cells.pop(edge, []):
+            bucket = self.edge_index.get(cell)
+            if bucket is not None:
+                bucket.discard(edge)
+                if not bucket:
+                    del self.edge_index[cell]
+
+    def build_edge_index(self):
+        self.edge_index = {}
+        self.edge_cells = {}
+        self.edge_index_bounds = None
+        for edge in self.edges:
+            self.index_edge(edge)
+
+    def project_on_edge(self, px, py, node1, node2):
+        # Trả về (proj_x, proj_y, offset, dist_sq), offset là tỉ lệ 0..1 tính từ node1 đến node2
+        x1, y1 = self.nodes[node1]
+        x2, y2 = self.nodes[node2]
+        dx, dy = x2 - x1, y2 - y1
+        length_sq = dx ** 2 + dy ** 2
+        if length_sq == 0:
+            t = 0.0
+        else:
+            t = max(0.0, min(1.0, ((px - x1) * dx + (py - y1) * dy) / length_sq))
+        qx, qy = x1 + t * dx, y1 + t * dy
+        return qx, qy, t, (px - qx) ** 2 + (py - qy) ** 2
+
+    def edge_ring_cells(self, cx, cy, ring):
+        # Chỉ các ô trên chu vi vòng `ring` quanh (cx, cy), cắt theo vùng lưới đang có cạnh
+        bx_min, bx_max, by_min, by_max = self.edge_index_bounds
+        x_lo, x_hi = max(cx - ring, bx_min), min(cx + ring, bx_max)
+        for ky in (cy - ring, cy + ring) if ring else (cy,):
+            if by_min <= ky <= by_max:
+                for kx in range(x_lo, x_hi + 1):
+                    yield (kx, ky)
+        if ring == 0:
+            return
+        y_lo, y_hi = max(cy - ring + 1, by_min), min(cy + ring - 1, by_max)
+        for kx in (cx - ring, cx + ring):
+            if bx_min <= kx <= bx_max:
+                for ky in range(y_lo, y_hi + 1):
+                    yield (kx, ky)
+
+    def find_nearest_edge(self, x, y):
+        # Duyệt lưới theo từng vòng quanh ô chứa điểm; dừng khi vòng tiếp theo chắc chắn xa hơn cạnh tốt nhất
+        if not self.edge_index:
+            return None
+        size = self.edge_index_cell_size
+        cx, cy = int(x // size), int(y // size)
+        bx_min, bx_max, by_min, by_max = self.edge_index_bounds
+        # Các vòng trước vòng đầu tiên chạm vùng lưới chắc chắn rỗng nên bỏ qua
+        first_ring = max(bx_min - cx, cx - bx_max, by_min - cy, cy - by_max, 0)
+        last_ring = max(cx - bx_min, bx_max - cx, cy - by_min, by_max - cy)
+        best = None
+        seen = set()
+        for ring in range(first_ring, last_ring + 1):
+            for cell in self.edge_ring_cells(cx, cy, ring):
+                for edge in self.edge_index.get(cell, ()):
+                    if edge in seen:
+                        continue
+                    seen.add(edge)
+                    projection = self.project_on_edge(x, y, edge[0], edge[1])
+                    # Hai chiều của cùng một đường cách đều nhau; so tên cạnh để kết quả không phụ thuộc thứ tự duyệt set
+                    if best is None or (projection[3], edge) < (best[1][3], best[0]):
+                        best = (edge, projection)
+            # Mọi cạnh chưa xét đều nằm ngoài các vòng đã duyệt, tức cách điểm ít nhất ring * size
+            if best is not None and best[1][3] <= (ring * size) ** 2:
+                break
+        return best
+
+    def attach_special_places(self, place_ids):
+        # Gắn hàng loạt special place vào cạnh gần nhất (chưa commit, để caller commit)
+        rows = []
+        for place_id in place_ids:
+            data = self.special_places.get(place_id)
+            nearest = self.find_nearest_edge(data['x'], data['y']) if data else None
+            if nearest is None:
+                self.place_attachments.pop(place_id, None)
+                self.cursor.execute("DELETE FROM special_place_edges WHERE place_id = ?", (place_id,))
+                continue
+            (node1, node2), (qx, qy, t, dist_sq) = nearest
+            self.place_attachments[place_id] = {'from': node1, 'to': node2, 'x': qx, 'y': qy,
+                                                'offset': t, 'dist': dist_sq ** 0.5}
+            rows.append((place_id, node1, node2, qx, qy, t, dist_sq ** 0.5))
+        if rows:
+            self.cursor.executemany("INSERT OR REPLACE INTO special_place_edges "
+                                    "(place_id, node_from, node_to, proj_x, proj_y, edge_offset, distance) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def detach_special_place(self, place_id):
+        self.place_attachments.pop(place_id, None)
+        self.cursor.execute("DELETE FROM special_place_edges WHERE place_id = ?", (place_id,))
+
+    def on_edges_added(self, edges):
+        # Chỉ gắn lại những place mà cạnh mới gần hơn cạnh đang gắn
+        for edge in edges:
+            self.index_edge(edge)
+        to_update = []
+        for place_id, data in self.special_places.items():
+            attachment = self.place_attachments.get(place_id)
+            for edge in edges:
+                if edge not in self.edge_cells:
+                    continue
+                dist_sq = self.project_on_edge(data['x'], data['y'], edge[0], edge[1])[3]
+                if attachment is None or dist_sq < attachment['dist'] ** 2:
+                    to_update.append(place_id)
+                    break
+        self.attach_special_places(to_update)
+        return to_update
+
+    def on_edges_removed(self, edges):
+        # Gỡ cạnh khỏi lưới rồi gắn lại các place đang bám vào những cạnh đó
+        removed = set(edges)
+        for edge in removed:
+            self.unindex_edge(edge)
+        orphaned = [place_id for place_id, attachment in self.place_attachments.items()
+                    if (attachment['from'], attachment['to']) in removed]
+        self.attach_special_places(orphaned)
+
+    def get_place_attachment(self, place_id):
+        # Điểm bắt đầu/kết thúc giữa cạnh cho tìm đường: (node_from, node_to, offset, proj_x, proj_y)
+        attachment = self.place_attachments.get(place_id)
+        if attachment is None:
+            return None
+        return attachment['from'], attachment['to'], attachment['offset'], attachment['x'], attachment['y']
     def wheelEvent(self,event):
         zoom_factor = 1.15  # Hệ số zoom
         min_scale = 0.2  # Giới hạn thu nhỏ
@@ -387,6 +565,13 @@ class GraphEditor(QGraphicsView):
         
         self.cursor.execute("SELECT id, custom_name, x, y FROM special_places")
         self.special_places = {row[0]: {'name': row[1], 'x': row[2], 'y': row[3]} for row in self.cursor.fetchall()}
+
+        self.build_edge_index()
+        self.cursor.execute("DELETE FROM special_place_edges WHERE place_id NOT IN (SELECT id FROM special_places)")
+        # DB có thể bị sửa ở nơi không cập nhật special_place_edges, nên tính lại toàn bộ một lượt bằng chỉ mục
+        self.place_attachments = {}
+        self.attach_special_places(list(self.special_places))
+        self.conn.commit()
         
         self.redraw_graph()
     
@@ -442,6 +627,12 @@ class GraphEditor(QGraphicsView):
             self.draw_special_place(QPointF(data['x'], data['y']), data['name'], place_id)
 
     def draw_special_place(self, pos, custom_name, place_id):
+        attachment = self.place_attachments.get(place_id)
+        if attachment:
+            # Nét đứt nối place với điểm chiếu trên cạnh đã gắn
+            self.scene.addLine(pos.x(), pos.y(), attachment['x'], attachment['y'],
+                               QPen(QColor("red"), 1, Qt.PenStyle.DashLine))
+
         # Marker for the special place (e.g., a red circle)
         marker_size = 12
         pen = QPen(QColor("red"))
@@ -467,7 +658,7 @@ class GraphEditor(QGraphicsView):
         action_type = action[0]
 
         if action_type == "node_added": # Undoing a node addition
-            node_name, _, _ = action
+            _, node_name, _, _ = action
             if node_name in self.nodes:
                 del self.nodes[node_name]
                 self.cursor.execute("DELETE FROM nodes WHERE name = ?", (node_name,))
@@ -477,14 +668,16 @@ class GraphEditor(QGraphicsView):
                     self.edges.remove(edge)
                     self.cursor.execute("DELETE FROM edges WHERE (node_from = ? AND node_to = ?) OR (node_from = ? AND node_to = ?)",
                                         (edge[0], edge[1], edge[1], edge[0])) # Handles undirected if stored both ways, or directed
+                self.on_edges_removed(edges_to_remove)
                 self.conn.commit()
                 self.redraw_graph()
                 print(f"Node {node_name} addition undone.")
 
         elif action_type == "node_removed": # Undoing a node removal (restore node and its edges)
-            node_name, x, y, restored_edges = action
+            _, node_name, x, y, restored_edges = action
             self.nodes[node_name] = (x, y)
             self.cursor.execute("INSERT INTO nodes (name, x, y) VALUES (?, ?, ?)", (node_name, x, y))
+            readded_edges = []
             for edge in restored_edges: # Restore edges that were connected to this node
                 node1, node2 = edge
                 # Recalculate weight or assume it was stored/not critical for this undo step
@@ -494,20 +687,24 @@ class GraphEditor(QGraphicsView):
                 if node1 in self.nodes and node2 in self.nodes: # Check if both nodes for edge exist
                     weight = self.calculate_weight(node1, node2) # Recalculate weight
                     self.edges.append(edge)
+                    readded_edges.append(edge)
                     self.cursor.execute("INSERT INTO edges (node_from, node_to, weight) VALUES (?, ?, ?)", (node1, node2, weight))
+            self.on_edges_added(readded_edges)
             self.conn.commit()
             self.redraw_graph()
             print(f"Node {node_name} restored.")
         
         elif action_type == "edge_added": # Undoing an edge addition
-            node1, node2, weight = action # Weight is the one that was stored (normal or car_mode modified)
+            _, node1, node2, weight = action # Weight is the one that was stored (normal or car_mode modified)
             edge_tuple = (node1, node2)
             reversed_edge_tuple = (node2, node1)
 
             if edge_tuple in self.edges:
                 self.edges.remove(edge_tuple)
+                self.on_edges_removed([edge_tuple])
             elif reversed_edge_tuple in self.edges: # Handle if stored reversed
                 self.edges.remove(reversed_edge_tuple)
+                self.on_edges_removed([reversed_edge_tuple])
                 
             self.cursor.execute("DELETE FROM edges WHERE (node_from = ? AND node_to = ?) OR (node_from = ? AND node_to = ?)", 
                                 (node1, node2, node2, node1))
@@ -523,24 +720,27 @@ class GraphEditor(QGraphicsView):
                 self.edges.append(edge_to_restore) # Add (n1,n2) to self.edges
                 self.cursor.execute("INSERT INTO edges (node_from, node_to, weight) VALUES (?, ?, ?)", 
                                     (node1, node2, original_weight))
+                self.on_edges_added([edge_to_restore])
                 self.conn.commit()
                 self.redraw_graph()
                 print(f"Edge {node1} -> {node2} (Weight: {original_weight:.2f}) restored.")
         
         elif action_type == "special_place_added": # Undoing a special place addition
-            place_id, _, _, _ = action 
+            _, place_id, _, _, _ = action 
             if place_id in self.special_places:
                 del self.special_places[place_id]
                 self.cursor.execute("DELETE FROM special_places WHERE id = ?", (place_id,))
+                self.detach_special_place(place_id)
                 self.conn.commit()
                 self.redraw_graph()
                 print(f"Addition of special place {place_id} undone.")
         
         elif action_type == "special_place_removed":
-            place_id, place_data = action
+            _, place_id, place_data = action
             self.special_places[place_id] = place_data
             self.cursor.execute("INSERT INTO special_places (id, custom_name, x, y) VALUES (?, ?, ?, ?)",
                                 (place_id, place_data['name'], place_data['x'], place_data['y']))
+            self.attach_special_places([place_id])
             self.conn.commit()
             self.redraw_graph()
             print(f"Removal of special place {place_data.get('name', place_id)} undone.")